@@ -1,3 +1,3 @@
-from .dataset import Dataset, collate_4D_batch
+from .dataset import Dataset, PersistentDataset, StreamDataLoader, collate_4D_batch
 from .transform import *
 from .components import *
\ No newline at end of file
@@ -1,15 +1,56 @@
+import os
+import re
+from typing import Union
+
 from monai.config import KeysCollection
 import numpy as np
 import torch
+import torch.nn.functional as F
 
 from monai.data import MetaTensor
-from monai.transforms import MapTransform, Resized
+from monai.networks.layers import GaussianFilter
+from monai.transforms import LoadImage, MapTransform, Randomizable, Resized, Transform
 from monai.transforms.utils import distance_transform_edt
 
 import nibabel as nib
 
 
-__all__ = ["Maskd", "DFConvertd", "Adjustd", "FlexResized", "Probd"]
+__all__ = ["LoadNPYd", "Maskd", "DFConvertd", "Adjustd", "FlexResized", "FusedResampled", "Probd", "RandIntensityBatch"]
+
+
+def npy_path(filename: str) -> tuple:
+    """
+    paths of the numpy array and affine matrix converted from a nifti or nrrd file.
+    """
+    stem = re.sub(r"(\.nii(\.gz)?|\.nrrd)$", "", str(filename))
+    return f"{stem}.npy", f"{stem}.affine.npy"
+
+
+class LoadNPYd(MapTransform):
+    """
+    load the numpy array converted from the nifti or nrrd file (see utils/convert_to_npy.py) as memory map,
+    which skips decompressing and parsing the header of the original file. falls back to load the original file
+    if it has not been converted.
+    """
+    def __init__(self, keys: KeysCollection, mmap_mode: str = "c", allow_missing_keys: bool = False) -> None:
+        super().__init__(keys, allow_missing_keys)
+        self.mmap_mode = mmap_mode
+        self.loader = LoadImage(ensure_channel_first=False, image_only=True)
+
+    def __call__(self, data):
+        d = dict(data)
+        for key in self.key_iterator(d):
+            array_path, affine_path = npy_path(d[key])
+            if os.path.exists(array_path) and os.path.exists(affine_path):
+                d[key] = MetaTensor(
+                    np.load(array_path, mmap_mode=self.mmap_mode), 
+                    affine=torch.from_numpy(np.load(affine_path)),
+                    meta={"filename_or_obj": d[key]}
+                    )
+            else:
+                d[key] = self.loader(d[key])
+
+        return d
 
 
 class Maskd(MapTransform):
@@ -61,10 +102,11 @@ class Adjustd(MapTransform):
     def __call__(self, data):
         for key in self.keys:
             try:
-                pixel_array = data[key].get_array().copy()
+                pixel_array = data[key].get_array()
 
                 if "label" in key:
-                    # combine label index 2 and 4 as ventricular myocardium
+                    # combine label index 2 and 4 as ventricular myocardium, only labels are modified thus copied
+                    pixel_array = pixel_array.copy()
                     pixel_array[pixel_array == 4] = 2
 
                 if len(pixel_array.shape) == 4:
@@ -129,6 +171,59 @@ class FlexResized(MapTransform):
         return data
 
 
+class FusedResampled(MapTransform):
+    """
+    crop the foreground of the label and resize it to fit in a cubic window, by a single nearest neighbour resampling.
+    this replaces the chain of isotropic resampling, foreground cropping, resizing to the longest side and padding,
+    which interpolates the label once per step. as part of the cached deterministic stage, the foreground bounding box
+    is computed once per case rather than every epoch.
+    """
+    def __init__(self, keys: KeysCollection, spatial_size: int, allow_missing_keys: bool = False) -> None:
+        super().__init__(keys, allow_missing_keys)
+        self.spatial_size = int(spatial_size)
+
+    def __call__(self, data):
+        d = dict(data)
+        for key in self.key_iterator(d):
+            label = d[key]
+            array = label.as_tensor().to(torch.float32)
+            shape = torch.tensor(array.shape[1:], dtype=torch.float64)
+            pixdim = torch.as_tensor(label.pixdim, dtype=torch.float64)
+
+            # bounding box of the foreground in voxel edge coordinates
+            foreground = torch.nonzero(array.amax(dim=0) > 0)
+            if foreground.shape[0] > 0:
+                box_start = foreground.amin(dim=0).to(torch.float64)
+                box_end = foreground.amax(dim=0).to(torch.float64) + 1
+            else:
+                box_start, box_end = torch.zeros_like(shape), shape
+            center = (box_start + box_end) / 2
+
+            # the longest side (in physical space) of the box fits the window, other sides are padded symmetrically
+            step = ((box_end - box_start) * pixdim).max() / self.spatial_size
+            scale = step / pixdim
+
+            # map the output grid to the input grid, in the normalised coordinates of grid_sample (x, y, z) order
+            theta = torch.zeros(1, 3, 4, dtype=torch.float64)
+            theta[0, :, :3] = torch.diag((self.spatial_size * scale / shape).flip(0))
+            theta[0, :, 3] = (2 * center / shape - 1).flip(0)
+            grid = F.affine_grid(
+                theta.to(array), [1, array.shape[0]] + [self.spatial_size] * 3, align_corners=False
+                )
+            array = F.grid_sample(
+                array[None], grid, mode="nearest", padding_mode="zeros", align_corners=False
+                )[0]
+
+            # update the affine
+            m = torch.eye(4, dtype=torch.float64)
+            m[:3, :3] = torch.diag(scale)
+            m[:3, -1] = center - 0.5 + (0.5 - self.spatial_size / 2) * scale
+            affine = label.affine.to(torch.float64) @ m
+            d[key] = MetaTensor(array, affine=affine)
+
+        return d
+
+
 class Probd(MapTransform):
     """
     read the input data to see its shape and dimension.
@@ -148,28 +243,27 @@ class Probd(MapTransform):
 class DFConvertd(MapTransform):
     """
     this transform convert the ground truth segmentation to signed distance fields.
+    distance fields are computed and kept on the given device, with CUDA device the distance transform is done by cuCIM.
     """
-    def __init__(self, key: KeysCollection, allow_missing_keys: bool = False) -> None:
+    def __init__(self, key: KeysCollection, device: Union[str, torch.device] = "cpu", allow_missing_keys: bool = False) -> None:
         super().__init__(key, allow_missing_keys)
         self.key = key
         self.modal = key[:2]
+        self.device = device
 
     def __call__(self, data):
         label = data[self.key]
-        label = label.as_tensor().clone()
+        label = label.as_tensor().to(self.device)
 
         # four classes (background: 0, left ventricle: 1, myocardium: 2, right ventricle: 3)
-        foreground = label > 0
-        lv = label == 1
-        myo = label == 2
-        rv = label == 3
+        # stacked as channels in the order of foreground, lv, rv, myo
+        masks = torch.cat([label > 0, label == 1, label == 3, label == 2], dim=0)
 
-        df = []
-        for c in [foreground, lv, rv, myo]:
-            df_class = distance_transform_edt(c) + distance_transform_edt(~c)
-            df.append(df_class[:, None])
+        # distance transform of all classes and their complements in one call
+        df = distance_transform_edt(torch.cat([masks, ~masks], dim=0))
+        df = df[:masks.shape[0]] + df[masks.shape[0]:]
 
-        df = MetaTensor(torch.cat(df, dim=1), affine=data[self.key].affine)
+        df = MetaTensor(df[None], affine=data[self.key].affine)
 
         data[f"{self.modal}_df"] = df
 
@@ -179,3 +273,44 @@ class DFConvertd(MapTransform):
         return data
 
 
+
+
+class RandIntensityBatch(Randomizable, Transform):
+    """
+    random intensity augmentation on a collated image batch, i.e., Gaussian noise, Gaussian smoothing and intensity scaling.
+    each item along the batch axis is augmented independently with the given probability, so that every augmentation 
+    is applied to the whole batch on device at once rather than per sample in the data loader.
+    """
+    def __init__(
+            self, prob: float = 0.15, std: float = 0.01, 
+            sigma: tuple = (0.5, 1.15), factors: float = 0.3
+            ) -> None:
+        self.prob = prob
+        self.std = std
+        self.sigma = sigma
+        self.factors = factors
+
+    def randomize(self, batch: int, spatial_dims: int) -> None:
+        self._noise_std = (self.R.random_sample(batch) < self.prob) * self.R.uniform(0, self.std, batch)
+        self._smooth_idx = np.flatnonzero(self.R.random_sample(batch) < self.prob)
+        self._smooth_sigma = self.R.uniform(*self.sigma, spatial_dims).tolist()
+        self._scale = (self.R.random_sample(batch) < self.prob) * self.R.uniform(-self.factors, self.factors, batch)
+
+    def __call__(self, img: torch.Tensor) -> torch.Tensor:
+        shape = (img.shape[0],) + (1,) * (img.dim() - 1)
+        self.randomize(img.shape[0], img.dim() - 2)
+
+        if self._noise_std.any():
+            std = torch.as_tensor(self._noise_std, dtype=img.dtype, device=img.device).view(shape)
+            img = img + std * torch.randn_like(img)
+
+        if len(self._smooth_idx) > 0:
+            idx = torch.as_tensor(self._smooth_idx, device=img.device)
+            smooth = GaussianFilter(img.dim() - 2, self._smooth_sigma).to(img.device)
+            img = img.index_copy(0, idx, smooth(img.index_select(0, idx)))
+
+        if self._scale.any():
+            scale = torch.as_tensor(self._scale, dtype=img.dtype, device=img.device).view(shape)
+            img = img * (1 + scale)
+
+        return img
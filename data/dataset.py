@@ -1,5 +1,6 @@
 import os
 import sys
+from copy import deepcopy
 from glob import glob
 from pathlib import Path
 from typing import Callable, Dict, List, Sequence, Union, SupportsIndex
@@ -9,11 +10,13 @@ import numpy as np
 from monai.config.type_definitions import PathLike
 from monai.data import (
     CacheDataset,
+    PersistentDataset as _PersistentDataset,
     partition_dataset,
     select_cross_validation_folds,
 )
-from monai.data.utils import list_data_collate
-from monai.transforms import LoadImaged, Randomizable, MapTransform, Transform
+from monai.data.thread_buffer import ThreadDataLoader, buffer_iterator
+from monai.data.utils import list_data_collate, pickle_hashing
+from monai.transforms import LoadImaged, Randomizable, MapTransform, Transform, apply_transform
 from monai.utils.type_conversion import convert_data_type, convert_to_dst_type
 
 from torch.utils.data import Dataset
@@ -24,7 +27,7 @@ from pytorch3d.structures import Meshes, Pointclouds
 
 import torch
 
-__all__ = ["Dataset", "collate_4D_batch"]
+__all__ = ["Dataset", "PersistentDataset", "StreamDataLoader", "collate_4D_batch"]
 
 
 def collate_4D_batch(data: List[Dict[str, Union[torch.Tensor, np.ndarray]]]) -> Dict[str, torch.Tensor]:
@@ -49,11 +52,61 @@ def collate_4D_batch(data: List[Dict[str, Union[torch.Tensor, np.ndarray]]]) ->
     return batch
 
 
+def _record_stream(data, stream: torch.cuda.Stream) -> None:
+    """
+    Mark the device tensors in a batch as in use by the given stream.
+    """
+    if isinstance(data, torch.Tensor):
+        if data.is_cuda:
+            data.record_stream(stream)
+    elif isinstance(data, dict):
+        for value in data.values():
+            _record_stream(value, stream)
+    elif isinstance(data, (list, tuple)):
+        for value in data:
+            _record_stream(value, stream)
+
+
+class StreamDataLoader(ThreadDataLoader):
+    """
+        :params 
+            dataset: input dataset, the random transforms of which run on the device.
+            buffer_size: number of batches to prefetch in the background thread.
+            kwargs: other arguments for `ThreadDataLoader`.
+
+        batches are prepared in a background thread on a side CUDA stream, thus the host-to-device copies and the random transforms overlap with the computation of the previous step.
+    """
+    def __init__(self, dataset, buffer_size: int = 1, **kwargs):
+        super().__init__(dataset, buffer_size=buffer_size, **kwargs)
+        self.stream = torch.cuda.Stream() if torch.cuda.is_available() else None
+
+    def _stream_iterator(self):
+        # the stream context is entered by the background thread that iterates this generator
+        with torch.cuda.stream(self.stream):
+            for batch in super(ThreadDataLoader, self).__iter__():
+                event = torch.cuda.Event()
+                event.record(self.stream)
+                yield batch, event
+
+    def __iter__(self):
+        if self.stream is None:
+            yield from super().__iter__()
+            return
+
+        for batch, event in buffer_iterator(self._stream_iterator(), self.buffer_size, self.buffer_timeout, self.repeats):
+            # synchronise against the compute stream at the point of use
+            compute_stream = torch.cuda.current_stream()
+            compute_stream.wait_event(event)
+            _record_stream(batch, compute_stream)
+            yield batch
+
+
 class Dataset(Randomizable, CacheDataset):
     """
         :params 
             data: list of dictionary -- {'label': label_path, 'image': image_path}
-            transform: composed MONAI transforms to execute operations on input data.
+            transform: composed MONAI transforms to execute operations on input data, the deterministic part is cached.
+            random_transform: composed MONAI transforms executed on top of the cached data at every fetch, e.g., data augmentation.
             seed: random seed to randomly shuffle the datalist before splitting into training and validation, default is 0. note to set same seed for `training` and `validation` sections.
             cache_num: number of items to be cached. Default is `sys.maxsize`. will take the minimum of (cache_num, data_length x cache_rate, data_length).
             cache_rate: percentage of cached data in total, default is 1.0 (cache all). will take the minimum of (cache_num, data_length x cache_rate, data_length).
@@ -67,17 +120,64 @@ class Dataset(Randomizable, CacheDataset):
             cache_num: int = sys.maxsize,
             cache_rate: float = 1.0,
             num_workers: int = 0,
+            random_transform: Union[Sequence[Callable], Callable, None] = None,
             ):
         self.set_random_state(seed=seed)
         self.indices: np.ndarray = np.array([])
+        self.random_transform = random_transform
         
         CacheDataset.__init__(
             self, data, transform, cache_num=cache_num, cache_rate=cache_rate, num_workers=num_workers,
             )
 
+    def _transform(self, index: int):
+        data = CacheDataset._transform(self, index)
+        if self.random_transform is not None:
+            # keep the cached data untouched from the random transforms
+            data = apply_transform(self.random_transform, deepcopy(data) if self.copy_cache else data)
+        return data
+
     def get_indices(self) -> np.ndarray:
         """
         Get the indices of datalist used in this dataset.
         """
         return self.indices
 
+
+class PersistentDataset(Randomizable, _PersistentDataset):
+    """
+        :params 
+            data: list of dictionary -- {'label': label_path, 'image': image_path}
+            transform: composed MONAI transforms to execute operations on input data, the deterministic part is cached on disk.
+            seed: random seed to randomly shuffle the datalist before splitting into training and validation, default is 0. note to set same seed for `training` and `validation` sections.
+            cache_dir: directory of the persistent cache, which can be shared by runs with the same deterministic transforms.
+            random_transform: composed MONAI transforms executed on top of the cached data at every fetch, e.g., data augmentation.
+    """
+    def __init__(
+            self,
+            data: list,
+            transform: Union[Sequence[Callable], Callable] = (),
+            seed: int = 0,
+            cache_dir: Union[Path, str, None] = None,
+            random_transform: Union[Sequence[Callable], Callable, None] = None,
+            ):
+        self.set_random_state(seed=seed)
+        self.indices: np.ndarray = np.array([])
+        self.random_transform = random_transform
+
+        # the hash of the deterministic transforms is part of the cache key, any change of pre-processing invalidates the cache
+        _PersistentDataset.__init__(
+            self, data, transform, cache_dir=cache_dir, hash_transform=pickle_hashing,
+            )
+
+    def _transform(self, index: int):
+        data = _PersistentDataset._transform(self, index)
+        if self.random_transform is not None:
+            data = apply_transform(self.random_transform, data)
+        return data
+
+    def get_indices(self) -> np.ndarray:
+        """
+        Get the indices of datalist used in this dataset.
+        """
+        return self.indices
@@ -1,51 +1,69 @@
+from typing import Union
+
 import torch
 from monai.transforms import (
     Compose,
-    LoadImaged,
-    CropForegroundd,
     CopyItemsd,
     Orientationd,
-    RandScaleIntensityd,
-    RandGaussianNoised,
-    RandGaussianSmoothd,
     RandRotate90d,
     RandZoomd,
     RandFlipd,
-    Resized,
-    ResizeWithPadOrCropd,
     ScaleIntensityd,
     Spacingd,
     SpatialPadd,
-    EnsureTyped
+    EnsureTyped,
+    Transform,
 )
+from monai.transforms.inverse import TraceableTransform
 
 from .components import *
 
 __all__ = ["pre_transform"]
 
 
+def _disable_tracing(transform) -> None:
+    """
+    Disable the tracing of applied operations of the transform, meta data such as the affine are still updated.
+    """
+    if isinstance(transform, TraceableTransform):
+        transform.set_tracing(False)
+    # composed and dictionary transforms delegate to the transforms held as attributes
+    for attr in vars(transform).values():
+        for t in (attr if isinstance(attr, (list, tuple)) else [attr]):
+            if isinstance(t, Transform):
+                _disable_tracing(t)
+
+
 def pre_transform(
         keys: tuple, modal: str, section: str, rotation: bool,
-        crop_window_size: list, pixdim: list, spacing: float = 2.0,
-        **kwargs
+        ds_shape: tuple, spacing: float = 2.0,
+        device: Union[str, torch.device] = "cpu", **kwargs
 ):
     """
     Conducting pre-transformation that comprises multichannel conversion,
     resampling in regard of space distance, reorientation, foreground cropping,
     normalization and data augmentation.
+
+    the pipeline is split into a deterministic stage (loading, resampling, distance
+    field conversion and normalisation) that is computed once and cached by the dataset,
+    and a random stage (data augmentation and type casting) executed on every fetch.
     
     :params
         keys: designated items for pre-transformation (image and label).
         modal: modality of data the pre-transformation applied to.
         section: identifier of either train, valid or test set.
         rotation: whether to apply rotation augmentation.
-        crop_window_size: image and label will be cropped to match the size of network input.
-        pixdim: the spatial distance of the downsampled images and labels.
+        ds_shape: spatial shape of the downsampled label the distance field is computed on.
         spacing: target spacing for isotropic resampling.
+        device: device the random stage and the distance field conversion are executed on, 
+            cached images, labels and distance fields stay in the host memory.
+
+    :return
+        deterministic and random transforms as a tuple of Compose.
     """
     # data loading
     transforms = [
-        LoadImaged(keys, ensure_channel_first=False, image_only=True, allow_missing_keys=True),
+        LoadNPYd(keys, allow_missing_keys=True),
     ]
 
     # pre-transformation
@@ -73,90 +91,53 @@ def pre_transform(
         CopyItemsd(keys[1], names=f"{keys[1]}_ds"),         # keys: {"image", "label", "label_ds"}
 
         # distance field transformation
-        # resampling and cropping                           keys: {"image", "label"}
-        Spacingd(f"{keys[1]}_ds", [spacing] * 3,
-                mode="nearest", padding_mode="zeros"),
-        CropForegroundd(f"{keys[1]}_ds", source_key=f"{keys[1]}_ds"),
+        # resampling, cropping and resizing in one pass    keys: {"image", "label"}
+        FusedResampled(f"{keys[1]}_ds", ds_shape[0]),
         # create distance field from down-sampled label
-        Maskd([f"{keys[1]}_ds", f"{keys[1][:2]}"], allow_missing_keys=True),
-        FlexResized(
-            f"{keys[1]}_ds", 
-            (-1, crop_window_size[0], -1)
-            ),
-        Resized(
-            f"{keys[1]}_ds", 
-            int(crop_window_size[0] // pixdim[0]), 
-            size_mode="longest", mode="nearest-exact"
-            ),
-        ResizeWithPadOrCropd(
-            f"{keys[1]}_ds", 
-            int(crop_window_size[0] // pixdim[0]), 
-            mode="constant", value=0
-            ),
-        DFConvertd(f"{keys[1]}_ds"),                        # keys: {"image", "label", "df"}
+        DFConvertd(f"{keys[1]}_ds", device=device),         # keys: {"image", "label", "df"}
     ])
 
     # ensure images are with normalised intensity
     transforms.append(ScaleIntensityd(keys[0]))
 
+    # cache images in half precision and labels in 8 bits, distance fields are moved back to the host in single precision
+    transforms.extend([
+        EnsureTyped(keys[0], data_type="tensor", dtype=torch.float16, allow_missing_keys=True),
+        EnsureTyped(keys[1], data_type="tensor", dtype=torch.int8, allow_missing_keys=True),
+        EnsureTyped(f"{keys[0][:2]}_df", data_type="tensor", dtype=torch.float32, device="cpu", allow_missing_keys=True),
+    ])
+
+    # move the cached data onto the device before casting, so that the transfer is in the cached precision
+    random_transforms = [
+        EnsureTyped([*keys, f"{keys[0][:2]}_df"], 
+                    data_type="tensor", device=device, allow_missing_keys=True),
+        EnsureTyped([*keys, f"{keys[0][:2]}_df"], 
+                    data_type="tensor", dtype=torch.float32, allow_missing_keys=True),
+    ]
+
     # random data augmentation
     if section == "train":
+        # intensity argmentation is applied on the image batch, see RandIntensityBatch
+        random_transforms.extend([
+            # spatial augmentation
+            RandZoomd(
+                keys,
+                min_zoom=0.9 if modal == "ct" else [1.0, 0.9, 0.9], 
+                max_zoom=1.2 if modal == "ct" else [1.0, 1.2, 1.2],
+                mode=("trilinear", "nearest-exact"),
+                align_corners=(True, None),
+                prob=0.15,
+            ),
+        ])
         if rotation:
-            transforms.extend([
-                # intensity argmentation (image only)
-                RandGaussianNoised(keys[0], std=0.01, prob=0.15),
-                RandGaussianSmoothd(
-                    keys[0],
-                    sigma_x=(0.5, 1.15),
-                    sigma_y=(0.5, 1.15),
-                    sigma_z=(0.5, 1.15),
-                    prob=0.15,
-                ),
-                RandScaleIntensityd(keys[0], factors=0.3, prob=0.15),
-                # spatial augmentation
-                RandZoomd(
-                    keys,
-                    min_zoom=0.9 if modal == "ct" else [1.0, 0.9, 0.9], 
-                    max_zoom=1.2 if modal == "ct" else [1.0, 1.2, 1.2],
-                    mode=("trilinear", "nearest-exact"),
-                    align_corners=(True, None),
-                    prob=0.15,
-                ),
+            random_transforms.extend([
                 RandRotate90d(keys, prob=0.5, spatial_axes=(1, 2)),
                 RandFlipd(keys, prob=0.5, spatial_axis=[1]),
                 RandFlipd(keys, prob=0.5, spatial_axis=[2]),
-                # ensure the data type
-                EnsureTyped([*keys, f"{keys[0][:2]}_df"], data_type="tensor", dtype=torch.float32),
             ])
-        else:
-            transforms.extend([
-                # intensity argmentation (image only)
-                RandGaussianNoised(keys[0], std=0.01, prob=0.15),
-                RandGaussianSmoothd(
-                    keys[0],
-                    sigma_x=(0.5, 1.15),
-                    sigma_y=(0.5, 1.15),
-                    sigma_z=(0.5, 1.15),
-                    prob=0.15,
-                ),
-                RandScaleIntensityd(keys[0], factors=0.3, prob=0.15),
-                # spatial augmentation
-                RandZoomd(
-                    keys,
-                    min_zoom=0.9 if modal == "ct" else [1.0, 0.9, 0.9], 
-                    max_zoom=1.2 if modal == "ct" else [1.0, 1.2, 1.2],
-                    mode=("trilinear", "nearest-exact"),
-                    align_corners=(True, None),
-                    prob=0.15,
-                ),
-                # ensure the data type
-                EnsureTyped([*keys, f"{keys[0][:2]}_df"], data_type="tensor", dtype=torch.float32),
-            ])
-    else:
-        transforms.append(
-            EnsureTyped([*keys, f"{keys[0][:2]}_df"], 
-                        data_type="tensor", dtype=torch.float32, allow_missing_keys=True)
-            )
 
-    return Compose(transforms)
+    # none of the deterministic transforms is inverted, skip recording the applied operations on every sample
+    transforms = Compose(transforms)
+    _disable_tracing(transforms)
 
+    return transforms, Compose(random_transforms)
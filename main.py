@@ -1,6 +1,8 @@
 import os, sys
+# keep the freed blocks in the caching allocator and limit the splitting of large blocks to reduce fragmentation,
+# this must be set before torch initialises CUDA (expandable segments need PyTorch >= 2.1, thus not used)
+os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "max_split_size_mb:512")
 import time
-from glob import glob
 import argparse
 import torch
 import wandb
@@ -39,6 +41,7 @@ def config():
     parser.add_argument("--lr", type=float, default=1e-3, help="the learning rate for training")
     parser.add_argument("--batch_size", type=int, default=1, help="the batch size for training")
     parser.add_argument("--cache_rate", type=float, default=1.0, help="the cache rate for training, see MONAI document for more details")
+    parser.add_argument("--cache_dir", type=str, default=None, help="the path to cache the pre-processed data on disk, data are cached in memory if not specified")
     parser.add_argument("--crop_window_size", type=int, nargs='+', default=[128, 128, 128], help="the size of the crop window for training")
     parser.add_argument("--pixdim", type=float, nargs='+', default=[4, 4, 4], help="the pixel dimension of downsampled images")
     parser.add_argument("--lambda_0", type=float, default=1.0, help="the loss coefficients for Chamfer verts distance term")
@@ -106,7 +109,7 @@ def train(super_params):
     with wandb.init(config=super_params, mode=super_params.mode, project="MorphiNet", name=super_params.run_id):
         pipeline = TrainPipeline(
             super_params=super_params,
-            seed=8, num_workers=12,
+            seed=8, num_workers=os.cpu_count(),
             )
 
         if super_params.save_on == "cap" and super_params._4d:
@@ -123,7 +126,6 @@ def train(super_params):
         else:
             # train the network
             for epoch in range(super_params.max_epochs):
-                torch.cuda.empty_cache()
                 if epoch < super_params.pretrain_epochs:
                     if super_params.use_ckpt is None:
                         # 1. train segmentation encoder
@@ -15,6 +15,7 @@
 """
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 from collections.abc import Callable
 from functools import partial
@@ -45,7 +46,7 @@ class AutoEncoder(nn.Module):
         self.encoder = encoder
         self.decoder = decoder
 
-        num_layers = torch.log2(torch.tensor(downsample_scale)).int().item()
+        num_layers = int(downsample_scale).bit_length() - 1
         ds_layer = []
         for _ in range(num_layers):
             ds_layer.extend([
@@ -57,8 +58,6 @@ class AutoEncoder(nn.Module):
                 ])
         self.ds_block = nn.Sequential(*ds_layer)
 
-        self.relu = nn.ReLU(inplace=True)
-
     def forward(self, x):
         x_seg = self.encoder(x)
         x_df = self.ds_block(x_seg)
@@ -77,7 +76,7 @@ class DownSample(nn.Module):
         conv_type: Union[nn.Conv1d, nn.Conv2d, nn.Conv3d] = Conv[Conv.CONV, spatial_dims]
         norm_type: Union[nn.BatchNorm1d, nn.BatchNorm2d, nn.BatchNorm3d] = Norm[Norm.BATCH, spatial_dims]
 
-        num_layers = torch.log2(torch.tensor(downsample_scale)).int().item()
+        num_layers = int(downsample_scale).bit_length() - 1
         ds_layer = []
         for _ in range(num_layers):
             ds_layer.extend([
@@ -89,8 +88,6 @@ class DownSample(nn.Module):
                 ])
         self.ds_block = nn.Sequential(*ds_layer)
 
-        self.relu = nn.ReLU(inplace=True)
-
     def forward(self, x_seg):
         x_df = self.ds_block(x_seg)
 
@@ -123,6 +120,9 @@ class ResNet(nn.Module):
         feed_forward: whether to add the FC layer for the output, default to `True`.
         bias_downsample: whether to use bias term in the downsampling block when `shortcut_type` is 'B', default to `True`.
 
+    Note: the cuDNN autotuner (`torch.backends.cudnn.benchmark`) selects the convolution algorithms per input shape,
+    the input spatial size should stay constant (16 x 16 x 16 after preprocessing) for them to be reused.
+
     """
 
     def __init__(
@@ -190,17 +190,17 @@ class ResNet(nn.Module):
 
         for m in self.modules():
             if isinstance(m, conv_type):
-                nn.init.kaiming_normal_(torch.as_tensor(m.weight), mode="fan_out", nonlinearity="relu")
+                nn.init.kaiming_normal_(m.weight, mode="fan_out", nonlinearity="relu")
             elif isinstance(m, norm_type):
-                nn.init.constant_(torch.as_tensor(m.weight), 1)
-                nn.init.constant_(torch.as_tensor(m.bias), 0)
+                nn.init.constant_(m.weight, 1)
+                nn.init.constant_(m.bias, 0)
             elif isinstance(m, nn.Linear):
-                nn.init.constant_(torch.as_tensor(m.bias), 0)
+                nn.init.constant_(m.bias, 0)
 
     def _downsample_basic_block(self, x: torch.Tensor, planes: int, stride: int, spatial_dims: int = 3) -> torch.Tensor:
         out: torch.Tensor = get_pool_layer(("avg", {"kernel_size": 1, "stride": stride}), spatial_dims=spatial_dims)(x)
-        zero_pads = torch.zeros(out.size(0), planes - out.size(1), *out.shape[2:], dtype=out.dtype, device=out.device)
-        out = torch.cat([out.data, zero_pads], dim=1)
+        # zero-pad the channels in one op, the padding of the last dimensions comes first
+        out = F.pad(out.data, (0, 0) * spatial_dims + (0, planes - out.size(1)))
         return out
 
     def _make_layer(
@@ -318,6 +318,7 @@ from torch_geometric.typing import (
 from torch_geometric.nn import MessagePassing, DeepGCNLayer, GCNConv
 from torch_geometric.nn.dense.linear import Linear as DenseLinear
 from torch_geometric.utils import degree
+from torch_scatter import scatter
 
 
 # function for pre-computed faces index
@@ -326,58 +327,67 @@ class Subdivision():
     def __init__(self, 
                  mesh: Meshes, num_layers: int,
                  mesh_label: torch.LongTensor=None,
-                 allow_subdiv_faces: List[torch.LongTensor]=[None, None]
+                 allow_subdiv_faces: List[torch.LongTensor]=[None, None],
+                 device: torch.device=None,
                  ) -> list:
         
         self.faces_levels = []
         self.labels_levels = []
+        edges_levels = []
         for l in range(num_layers):
             new_faces = self.subdivide_faces_fn(mesh, allow_subdiv_faces[l])
-            self.faces_levels.append(new_faces)
+            # faces are moved to the device of the model once, rather than in every forward pass of GSN
+            self.faces_levels.append(new_faces.to(device) if device is not None else new_faces)
             verts = mesh.verts_packed()
             edges = mesh.edges_packed()
-            new_verts = verts[edges].mean(dim=1)
+            edges_levels.append(edges)
+            new_verts = 0.5 * (verts.index_select(0, edges[:, 0]) + verts.index_select(0, edges[:, 1]))
             new_verts = torch.cat([verts, new_verts], dim=0)
             mesh = Meshes(verts=[new_verts], faces=[new_faces])
 
-            # mesh_label = mesh_label.tile([4]) if mesh_label is not None else None
-            # self.labels_levels.append(mesh_label)
-            mesh_label = torch.cat([mesh_label, mesh_label[edges].max(dim=1).values], dim=0)
-            self.labels_levels.append(mesh_label)
+        if mesh_label is not None:
+            # the labels of each level extend those of the previous level, thus they are views of a single allocation
+            num_labels = mesh_label.shape[0]
+            labels = torch.empty(
+                (num_labels + sum(edges.shape[0] for edges in edges_levels), *mesh_label.shape[1:]),
+                dtype=mesh_label.dtype, device=mesh_label.device
+                )
+            labels[:num_labels] = mesh_label
+            for edges in edges_levels:
+                labels[num_labels:num_labels + edges.shape[0]] = labels[edges].max(dim=1).values
+                num_labels += edges.shape[0]
+                self.labels_levels.append(labels[:num_labels])
 
     def subdivide_faces_fn(self, mesh: Meshes, allow_subdiv_faces: torch.LongTensor=None):
         verts_packed = mesh.verts_packed()
-        faces_packed = mesh.faces_packed()
+        orig_faces = mesh.faces_packed()
+        faces_packed = orig_faces
         faces_packed_to_edges_packed = (
             verts_packed.shape[0] + mesh.faces_packed_to_edges_packed()
         )
         if allow_subdiv_faces is not None:
-            faces_packed = faces_packed[allow_subdiv_faces]
+            faces_packed = orig_faces[allow_subdiv_faces]
             faces_packed_to_edges_packed = faces_packed_to_edges_packed[allow_subdiv_faces]
 
-        f0 = torch.stack([
-            faces_packed[:, 0],                     # 0
-            faces_packed_to_edges_packed[:, 2],     # 3
-            faces_packed_to_edges_packed[:, 1],     # 4
-        ], dim=1)
-        f1 = torch.stack([
-            faces_packed[:, 1],                     # 1
-            faces_packed_to_edges_packed[:, 0],     # 5
-            faces_packed_to_edges_packed[:, 2],     # 3
-        ], dim=1)
-        f2 = torch.stack([
-            faces_packed[:, 2],                     # 2
-            faces_packed_to_edges_packed[:, 1],     # 4
-            faces_packed_to_edges_packed[:, 0],     # 5
-        ], dim=1)
-        f3 = faces_packed_to_edges_packed           # 5, 4, 3
-
-        subdivided_faces_packed = torch.cat([f0, f1, f2, f3], dim=0)
-
-        if allow_subdiv_faces is not None:
-            subdivided_faces_packed = torch.cat(
-                [mesh.faces_packed()[~allow_subdiv_faces], subdivided_faces_packed], dim=0
+        # faces kept without subdivision come first, followed by the four sub-faces of the subdivided faces
+        kept_faces = orig_faces[~allow_subdiv_faces] if allow_subdiv_faces is not None else orig_faces[:0]
+        n_kept, n_faces = kept_faces.shape[0], faces_packed.shape[0]
+        subdivided_faces_packed = torch.empty(
+            (n_kept + 4 * n_faces, 3), dtype=faces_packed.dtype, device=faces_packed.device
             )
+        subdivided_faces_packed[:n_kept] = kept_faces
+        f0, f1, f2, f3 = subdivided_faces_packed[n_kept:].view(4, n_faces, 3)
+
+        f0[:, 0] = faces_packed[:, 0]                   # 0
+        f0[:, 1] = faces_packed_to_edges_packed[:, 2]   # 3
+        f0[:, 2] = faces_packed_to_edges_packed[:, 1]   # 4
+        f1[:, 0] = faces_packed[:, 1]                   # 1
+        f1[:, 1] = faces_packed_to_edges_packed[:, 0]   # 5
+        f1[:, 2] = faces_packed_to_edges_packed[:, 2]   # 3
+        f2[:, 0] = faces_packed[:, 2]                   # 2
+        f2[:, 1] = faces_packed_to_edges_packed[:, 1]   # 4
+        f2[:, 2] = faces_packed_to_edges_packed[:, 0]   # 5
+        f3[:] = faces_packed_to_edges_packed            # 5, 4, 3
 
         return subdivided_faces_packed
     
@@ -411,16 +421,25 @@ class GSNLayer(MessagePassing):
                 if m.bias is not None:
                     nn.init.zeros_(m.bias)
 
-    def forward(self, x, edge_index):
-        # Step 2: normalisation
+    @staticmethod
+    def normalise(edge_index, num_nodes, dtype=torch.float32):
+        # symmetric degree normalisation of the edges, which only depends on the mesh topology
         row, col = edge_index
-        deg = degree(col, x.size(0), dtype=x.dtype)
+        deg = degree(col, num_nodes, dtype=dtype)
         deg_inv_sqrt = deg.pow(-0.5)
         deg_inv_sqrt[deg_inv_sqrt == float("inf")] = 0
-        norm = deg_inv_sqrt[row] * deg_inv_sqrt[col]
+        return deg_inv_sqrt[row] * deg_inv_sqrt[col]
 
-        # Step 3: propagating messages
-        x = self.propagate(edge_index, x=x, norm=norm)
+    def forward(self, x, edge_index, norm=None):
+        # Step 2: normalisation, skipped if pre-computed for the topology
+        if norm is None:
+            norm = self.normalise(edge_index, x.size(0), dtype=x.dtype)
+
+        # Step 3: propagating messages, gathered and summed at the target nodes directly rather than
+        # through propagate(), which collects and inspects the arguments of message() on every call
+        row, col = edge_index
+        msg = self.message(x.index_select(0, col), x.index_select(0, row), norm)
+        x = scatter(msg, col, dim=0, dim_size=x.size(0), reduce="sum")
 
         return x
 
@@ -439,33 +458,49 @@ class GSN(nn.Module):
             for _ in range(num_layers)
         ])
 
+        # edge index and normalisation of each level, which only depend on the subdivided faces and the batch size
+        self._topology_cache = {}
+
+    def _topology(self, level: int, verts: Tensor, faces: Tensor, subdivided_faces: torch.LongTensor = None):
+        key = (level, verts.shape[0], verts.device, verts.dtype)
+        cached = self._topology_cache.get(key)
+        # the cache is only valid for the same faces tensor, e.g., not after loading or reducing the subdivided faces
+        if subdivided_faces is not None and cached is not None and cached[0] is subdivided_faces:
+            return cached[1:]
+
+        edge_index = Meshes(verts=verts, faces=faces).edges_packed().t().contiguous()
+        norm = GSNLayer.normalise(edge_index, verts.shape[0] * verts.shape[1], dtype=verts.dtype)
+        if subdivided_faces is not None:
+            self._topology_cache[key] = (subdivided_faces, edge_index, norm)
+
+        return edge_index, norm
+
     def forward(self, meshes: Meshes, subdivided_faces: list[torch.LongTensor]):
-        
+        # the meshes in the batch share the same topology, thus the vertices and faces are kept as padded tensors
+        # and new Meshes are only created for the output of each level
+        verts = meshes.verts_padded()
+        faces = meshes.faces_padded()
+
         level_outs = []
+        edges = None
         for l, gcn_layer in enumerate(self.gcn_layers):
             if len(subdivided_faces) > 0:
-                # 1. create new vertices at the middle of the edges.
-                new_faces = subdivided_faces[l].expand(meshes._N, -1, -1).to(meshes.device)
-                verts = meshes.verts_padded()
-                edges = meshes[0].edges_packed()
-                edge_verts = verts[:, edges].mean(dim=2)
-                new_verts = torch.cat([verts, edge_verts], dim=1)
-            
-            else:
-                new_verts = meshes.verts_padded()
-                new_faces = meshes.faces_padded()
-
-            # 2. create new meshes with the same topology as the original mesh.
-            meshes = Meshes(verts=new_verts, faces=new_faces)
-
-            # 3. update the vertices with learnt offsets.
-            offsets = gcn_layer(
-                meshes.verts_packed(), meshes.edges_packed().t().contiguous()
-                )
-            meshes = meshes.offset_verts(offsets)
-
-            # 4. output the new mesh
-            level_outs.append(meshes)
+                # 1. create new vertices at the middle of the edges, edges of the previous level are reused.
+                edges = meshes[0].edges_packed() if edges is None else edges
+                edge_verts = 0.5 * (verts[:, edges[:, 0]] + verts[:, edges[:, 1]])
+                verts = torch.cat([verts, edge_verts], dim=1)
+                faces = subdivided_faces[l].expand(verts.shape[0], -1, -1)
+
+            # 2. update the vertices with learnt offsets, the packed vertices are the flattened padded ones.
+            edge_index, norm = self._topology(l, verts, faces, subdivided_faces[l] if len(subdivided_faces) > 0 else None)
+            offsets = gcn_layer(verts.reshape(-1, 3), edge_index, norm=norm)
+            verts = verts + offsets.view_as(verts)
+
+            # packed edges are sorted by vertex index, thus the edges of the first mesh come first
+            edges = edge_index[:, :edge_index.shape[1] // verts.shape[0]].t()
+
+            # 3. output the new mesh with the same topology as the original mesh.
+            level_outs.append(Meshes(verts=verts, faces=faces))
 
         return level_outs
 
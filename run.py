@@ -13,7 +13,6 @@ from pytorch3d.ops import sample_points_from_meshes, taubin_smoothing
 from pytorch3d.loss import chamfer_distance, point_mesh_face_distance
 from pytorch3d.structures import Meshes, Pointclouds
 from pytorch3d.ops.marching_cubes import marching_cubes
-from monai.data import DataLoader
 from monai.losses import DiceCELoss, MaskedDiceLoss
 from monai.metrics import DiceMetric, MSEMetric
 from monai.networks.nets import DynUNet, SegResNet
@@ -59,7 +58,7 @@ class TrainPipeline:
         :param 
             super_params: parameters for setting up dataset, network structure, training, etc.
             seed: random seed to shuffle data during augmentation.
-            num_workers: tourch.utils.data.DataLoader num_workers.
+            num_workers: number of threads to fill the dataset cache.
             is_training: switcher for training (True, default) or testing (False).
         """
             
@@ -70,6 +69,11 @@ class TrainPipeline:
         self.target = kwargs.get("target")
         set_determinism(seed=self.seed)
 
+        # spatial shape of the downsampled labels, derived once from the crop window size and pixel dimension
+        self.ds_shape = tuple(
+            int(w // p) for w, p in zip(self.super_params.crop_window_size, self.super_params.pixdim)
+            )
+
         if is_training:
             self.ckpt_dir = os.path.join(super_params.ckpt_dir, "dynamic", super_params.run_id)
             os.makedirs(self.ckpt_dir, exist_ok=True)
@@ -95,6 +99,10 @@ class TrainPipeline:
             self.out_dir = super_params.out_dir
             os.makedirs(self.out_dir, exist_ok=True)
 
+        # intensity augmentation applied on the training image batch
+        self.intensity_augment = RandIntensityBatch(prob=0.15, std=0.01, sigma=(0.5, 1.15), factors=0.3)
+        self.intensity_augment.set_random_state(seed=self.seed)
+
         # data augmentation for resizing the segmentation prediction into crop window size
         self.pred_transform = Compose([
             AsDiscrete(argmax=True),
@@ -197,15 +205,14 @@ class TrainPipeline:
 
 
     def _prepare_transform(self, keys, modal, rotation, **kwargs):
+        # each transform is a tuple of (deterministic, random) Compose
         train_transform = pre_transform(
             keys, modal, "train", rotation,
-            self.super_params.crop_window_size,
-            self.super_params.pixdim, **kwargs
+            self.ds_shape, device=DEVICE, **kwargs
             )
         valid_transform = pre_transform(
             keys, modal, "valid", rotation,
-            self.super_params.crop_window_size,
-            self.super_params.pixdim, **kwargs
+            self.ds_shape, device=DEVICE, **kwargs
             )
         
         return train_transform, valid_transform
@@ -235,45 +242,53 @@ class TrainPipeline:
         if not self.is_training:
             train_ds = None
             valid_ds = None
-            test_ds = Dataset(
-                test_data, valid_transform, self.seed, sys.maxsize,
-                self.super_params.cache_rate, self.num_workers
-                )
+            test_ds = self._create_dataset(test_data, valid_transform)
         else:
-            train_ds = Dataset(
-                train_data, train_transform, self.seed, sys.maxsize,
-                self.super_params.cache_rate, self.num_workers
-                )
-            valid_ds = Dataset(
-                valid_data, valid_transform, self.seed, sys.maxsize,
-                self.super_params.cache_rate, self.num_workers
-                )
+            train_ds = self._create_dataset(train_data, train_transform)
+            valid_ds = self._create_dataset(valid_data, valid_transform)
             test_ds = None
         
         return train_ds, valid_ds, test_ds
 
 
+    def _create_dataset(self, data, transform):
+        if self.super_params.cache_dir is None:
+            # cache the deterministic transforms in memory
+            return Dataset(
+                data, transform[0], self.seed, sys.maxsize,
+                self.super_params.cache_rate, self.num_workers,
+                random_transform=transform[1]
+                )
+        else:
+            # cache the deterministic transforms on disk
+            return PersistentDataset(
+                data, transform[0], self.seed, self.super_params.cache_dir,
+                random_transform=transform[1]
+                )
+
+
     def _prepare_dataloader(self, train_ds, valid_ds, test_ds):
+        # random transforms run on the device, thus data are loaded within the main process and prefetched on a side stream
         if not train_ds is None and train_ds.__len__() > 0:
-            train_loader = DataLoader(
-                train_ds, batch_size=self.super_params.batch_size,
-                shuffle=True, num_workers=self.num_workers,
+            train_loader = StreamDataLoader(
+                train_ds, buffer_size=4, batch_size=self.super_params.batch_size,
+                shuffle=True, num_workers=0,
                 collate_fn=collate_4D_batch,
                 )
         else:
             train_loader = None
         if not valid_ds is None and valid_ds.__len__() > 0:
-            val_loader = DataLoader(
+            val_loader = StreamDataLoader(
                 valid_ds, batch_size=1,
-                shuffle=False, num_workers=self.num_workers,
+                shuffle=False, num_workers=0,
                 collate_fn=collate_4D_batch,
                 )
         else:
             val_loader = None
         if not test_ds is None and test_ds.__len__() > 0:
-            test_loader = DataLoader(
+            test_loader = StreamDataLoader(
                 test_ds, batch_size=1,
-                shuffle=False, num_workers=self.num_workers,
+                shuffle=False, num_workers=0,
                 collate_fn=collate_4D_batch,
                 )
         else:
@@ -314,12 +329,21 @@ class TrainPipeline:
         ).to(DEVICE)
 
         # initialise the subdiv module
-        self.subdivided_faces = Subdivision(self.template_mesh, self.super_params.subdiv_levels, mesh_label=self.vert_label) # create pre-computed subdivision matrix
+        self.subdivided_faces = Subdivision(self.template_mesh, self.super_params.subdiv_levels, mesh_label=self.vert_label, device=DEVICE) # create pre-computed subdivision matrix
         self.GSN = GSN(
             hidden_features=self.super_params.hidden_features_gsn, 
             num_layers=self.super_params.subdiv_levels if self.super_params.subdiv_levels > 0 else 2,
         ).to(DEVICE)
 
+        # compile the convolutional networks that see fixed input shapes, torch.compile is available since PyTorch 2.0
+        # the forward is compiled in place, thus the state dict of the modules remains unchanged
+        if hasattr(torch, "compile"):
+            for module in (self.encoder_mr, self.encoder_ct, self.decoder):
+                module.forward = torch.compile(module.forward)
+            # the message MLPs of the subdiv module are plain tensor operations, the number of edges varies with the level
+            for gcn_layer in self.GSN.gcn_layers:
+                gcn_layer.lin.forward = torch.compile(gcn_layer.lin.forward, dynamic=True)
+
         # initialise th NDF module
         self.NDF = NODEBlock(
             hidden_size=16, atol=1, rtol=1e-2,
@@ -394,9 +418,15 @@ class TrainPipeline:
 
         # initialise the gradient scaler
         self.scaler = torch.cuda.amp.GradScaler()
+        # the convolutional networks run in bfloat16 where supported, which has the range of float32 and needs no loss scaling,
+        # the subdiv and ndf modules stay in float16 as the pytorch3d kernels in their losses have no bfloat16 support
+        self.amp_dtype = torch.bfloat16 if DEVICE == "cpu" or torch.cuda.is_bf16_supported() else torch.float16
         
         torch.backends.cudnn.enabled = torch.backends.cudnn.is_available()
         torch.backends.cudnn.benchmark = torch.backends.cudnn.is_available()
+        # allow TensorFloat-32 on Ampere or newer GPUs for the float32 convolutions and matmuls outside autocast
+        torch.backends.cudnn.allow_tf32 = True
+        torch.backends.cuda.matmul.allow_tf32 = True
 
 
     def surface_extractor(self, seg_true):
@@ -753,9 +783,10 @@ class TrainPipeline:
                     data_ct["ct_image"].as_tensor().to(DEVICE),
                     data_ct["ct_label"].as_tensor().to(DEVICE),
                     )
+                img_ct = self.intensity_augment(img_ct)
 
                 self.optimzer_ct_unet.zero_grad()
-                with torch.autocast(device_type=DEVICE):
+                with torch.autocast(device_type=DEVICE, dtype=self.amp_dtype):
                     seg_pred_ct = sliding_window_inference(
                         img_ct, 
                         roi_size=self.super_params.crop_window_size, 
@@ -782,9 +813,10 @@ class TrainPipeline:
                     data_mr["mr_image"].as_tensor().to(DEVICE),
                     data_mr["mr_label"].as_tensor().to(DEVICE),
                     )
+                img_mr = self.intensity_augment(img_mr)
 
                 self.optimzer_mr_unet.zero_grad()
-                with torch.autocast(device_type=DEVICE):
+                with torch.autocast(device_type=DEVICE, dtype=self.amp_dtype):
                     seg_pred_mr = sliding_window_inference(
                         img_mr,
                         roi_size=self.super_params.crop_window_size[:2],
@@ -825,9 +857,10 @@ class TrainPipeline:
                     data_ct["ct_image"].to(DEVICE),
                     data_ct["ct_label"].to(DEVICE),
                 )
+                img_ct = self.intensity_augment(img_ct)
 
                 self.optimizer_resnet.zero_grad()
-                with torch.autocast(device_type=DEVICE):
+                with torch.autocast(device_type=DEVICE, dtype=self.amp_dtype):
                     seg_pred_ct = sliding_window_inference(
                         img_ct,
                         roi_size=self.super_params.crop_window_size,
@@ -879,6 +912,7 @@ class TrainPipeline:
                     data_ct["ct_image"].to(DEVICE),
                     data_ct["ct_label"].to(DEVICE)
                 )
+                img_ct = self.intensity_augment(img_ct)
                 seg_true_ct_ = torch.stack([self.post_transform({"label": i, "modal": "ct"})["label"] for i in seg_true_ct], dim=0)
                 mesh_true_ct = self.surface_extractor(seg_true_ct_)
 
@@ -956,6 +990,7 @@ class TrainPipeline:
                     data_mr["mr_image"].to(DEVICE),
                     data_mr["mr_label"].to(DEVICE),
                 )
+                img_mr = self.intensity_augment(img_mr)
                 batch = data_mr["mr_batch"].item()
                 bbox = generate_spatial_bounding_box(seg_true_mr)
                 h, w = img_mr.shape[-2:]
@@ -992,8 +1027,7 @@ class TrainPipeline:
                             for i in [foreground, lv, rv, myo]], dim=1)
                         
                         template_mesh = self.warp_template_mesh(df_pred_mr.detach())
-                        del df_pred_mr, seg_pred_mr, seg_pred_mr_ds, seg_true_mr, mask, foreground, myo, img_mr # release memory
-                        torch.cuda.empty_cache()
+                        del df_pred_mr, seg_pred_mr, seg_pred_mr_ds, seg_true_mr, mask, foreground, myo, img_mr # release memory to the cache
                         try:
                             # method 1: NDF applied right after warping the control mesh
                             ndf_verts = self.NDF(template_mesh.verts_padded()[0], end_time=1, step=batch-1, invert=False)
@@ -1243,7 +1277,7 @@ class TrainPipeline:
                 torch.load(os.path.join(self.ckpt_dir, f"{self.super_params.best_epoch}_NDF.pth")))
         # load the subdivided_faces.faces_levels
         self.subdivided_faces.faces_levels = [torch.load(
-            glob.glob(f"{self.ckpt_dir}/*_subdivided_faces_l{level}.pth")[-1]
+            glob.glob(f"{self.ckpt_dir}/*_subdivided_faces_l{level}.pth")[-1], map_location=DEVICE
             ) for level in range(self.super_params.subdiv_levels)]
         self.decoder.eval()
         self.GSN.eval()
@@ -1322,7 +1356,11 @@ class TrainPipeline:
                     ], dim=0)     
                 seg_true = torch.stack([i["label"] for i in seg_data], dim=0)
 
-                actual_heart_size_in_pixel.append(list(seg_true.applied_operations[3 if self.super_params.target == "acdc" else 4]["orig_size"]))
+                # the heart size is the input size of the resizing right after the foreground cropping, looked up by
+                # class as the number of recorded operations depends on the (untraced) cached pre-processing
+                applied_operations = seg_true.applied_operations
+                crop_idx = next(i for i, op in enumerate(applied_operations) if op["class"] == "CropForeground")
+                actual_heart_size_in_pixel.append(list(applied_operations[crop_idx + 1]["orig_size"]))
 
                 seg_true = (seg_true == 2).to(torch.float32)
                 msh_metric_batch_decoder(voxeld_mesh, seg_true)
@@ -1403,7 +1441,7 @@ class TrainPipeline:
             torch.load(os.path.join(self.ckpt_dir, f"{self.super_params.best_epoch}_GSN.pth")))
         # load the subdivided_faces.faces_levels
         self.subdivided_faces.faces_levels = [torch.load(
-            glob.glob(f"{self.ckpt_dir}/*_subdivided_faces_l{level}.pth")[-1]
+            glob.glob(f"{self.ckpt_dir}/*_subdivided_faces_l{level}.pth")[-1], map_location=DEVICE
             ) for level in range(self.super_params.subdiv_levels)]
         self.decoder.eval()
         self.GSN.eval()
@@ -13,7 +13,6 @@ from pytorch3d.ops import sample_points_from_meshes, taubin_smoothing
 from pytorch3d.loss import chamfer_distance, point_mesh_face_distance
 from pytorch3d.structures import Meshes, Pointclouds
 from pytorch3d.ops.marching_cubes import marching_cubes
-from monai.data import DataLoader
 from monai.losses import DiceCELoss, MaskedDiceLoss
 from monai.metrics import DiceMetric, MSEMetric
 from monai.networks.nets import DynUNet, SegResNet
@@ -56,7 +55,7 @@ class TrainPipeline:
         :param 
             super_params: parameters for setting up dataset, network structure, training, etc.
             seed: random seed to shuffle data during augmentation.
-            num_workers: tourch.utils.data.DataLoader num_workers.
+            num_workers: number of threads to fill the dataset cache.
             is_training: switcher for training (True, default) or testing (False).
         """
             
@@ -67,6 +66,11 @@ class TrainPipeline:
         self.target = kwargs.get("target")
         set_determinism(seed=self.seed)
 
+        # spatial shape of the downsampled labels, derived once from the crop window size and pixel dimension
+        self.ds_shape = tuple(
+            int(w // p) for w, p in zip(self.super_params.crop_window_size, self.super_params.pixdim)
+            )
+
         if is_training:
             self.ckpt_dir = os.path.join(super_params.ckpt_dir, "dynamic", super_params.run_id)
             os.makedirs(self.ckpt_dir, exist_ok=True)
@@ -89,6 +93,10 @@ class TrainPipeline:
             self.out_dir = super_params.out_dir
             os.makedirs(self.out_dir, exist_ok=True)
 
+        # intensity augmentation applied on the training image batch
+        self.intensity_augment = RandIntensityBatch(prob=0.15, std=0.01, sigma=(0.5, 1.15), factors=0.3)
+        self.intensity_augment.set_random_state(seed=self.seed)
+
         # data augmentation for resizing the segmentation prediction into crop window size
         self.pred_transform = Compose([
             AsDiscrete(argmax=True),
@@ -178,15 +186,14 @@ class TrainPipeline:
 
 
     def _prepare_transform(self, keys, modal, rotation, **kwargs):
+        # each transform is a tuple of (deterministic, random) Compose
         train_transform = pre_transform(
             keys, modal, "train", rotation,
-            self.super_params.crop_window_size,
-            self.super_params.pixdim, **kwargs
+            self.ds_shape, device=DEVICE, **kwargs
             )
         valid_transform = pre_transform(
             keys, modal, "valid", rotation,
-            self.super_params.crop_window_size,
-            self.super_params.pixdim, **kwargs
+            self.ds_shape, device=DEVICE, **kwargs
             )
         
         return train_transform, valid_transform
@@ -207,45 +214,53 @@ class TrainPipeline:
         if not self.is_training:
             train_ds = None
             valid_ds = None
-            test_ds = Dataset(
-                test_data, valid_transform, self.seed, sys.maxsize,
-                self.super_params.cache_rate, self.num_workers
-                )
+            test_ds = self._create_dataset(test_data, valid_transform)
         else:
-            train_ds = Dataset(
-                train_data, train_transform, self.seed, sys.maxsize,
-                self.super_params.cache_rate, self.num_workers
-                )
-            valid_ds = Dataset(
-                valid_data, valid_transform, self.seed, sys.maxsize,
-                self.super_params.cache_rate, self.num_workers
-                )
+            train_ds = self._create_dataset(train_data, train_transform)
+            valid_ds = self._create_dataset(valid_data, valid_transform)
             test_ds = None
         
         return train_ds, valid_ds, test_ds
 
 
+    def _create_dataset(self, data, transform):
+        if self.super_params.cache_dir is None:
+            # cache the deterministic transforms in memory
+            return Dataset(
+                data, transform[0], self.seed, sys.maxsize,
+                self.super_params.cache_rate, self.num_workers,
+                random_transform=transform[1]
+                )
+        else:
+            # cache the deterministic transforms on disk
+            return PersistentDataset(
+                data, transform[0], self.seed, self.super_params.cache_dir,
+                random_transform=transform[1]
+                )
+
+
     def _prepare_dataloader(self, train_ds, valid_ds, test_ds):
+        # random transforms run on the device, thus data are loaded within the main process and prefetched on a side stream
         if not train_ds is None and train_ds.__len__() > 0:
-            train_loader = DataLoader(
-                train_ds, batch_size=self.super_params.batch_size,
-                shuffle=True, num_workers=self.num_workers,
+            train_loader = StreamDataLoader(
+                train_ds, buffer_size=4, batch_size=self.super_params.batch_size,
+                shuffle=True, num_workers=0,
                 collate_fn=collate_4D_batch,
                 )
         else:
             train_loader = None
         if not valid_ds is None and valid_ds.__len__() > 0:
-            val_loader = DataLoader(
+            val_loader = StreamDataLoader(
                 valid_ds, batch_size=1,
-                shuffle=False, num_workers=self.num_workers,
+                shuffle=False, num_workers=0,
                 collate_fn=collate_4D_batch,
                 )
         else:
             val_loader = None
         if not test_ds is None and test_ds.__len__() > 0:
-            test_loader = DataLoader(
+            test_loader = StreamDataLoader(
                 test_ds, batch_size=1,
-                shuffle=False, num_workers=self.num_workers,
+                shuffle=False, num_workers=0,
                 collate_fn=collate_4D_batch,
                 )
         else:
@@ -275,12 +290,21 @@ class TrainPipeline:
         ).to(DEVICE)
 
         # initialise the subdiv module
-        self.subdivided_faces = Subdivision(self.template_mesh, self.super_params.subdiv_levels, mesh_label=self.vert_label) # create pre-computed subdivision matrix
+        self.subdivided_faces = Subdivision(self.template_mesh, self.super_params.subdiv_levels, mesh_label=self.vert_label, device=DEVICE) # create pre-computed subdivision matrix
         self.GSN = GSN(
             hidden_features=self.super_params.hidden_features_gsn, 
             num_layers=self.super_params.subdiv_levels if self.super_params.subdiv_levels > 0 else 2,
         ).to(DEVICE)
 
+        # compile the convolutional networks that see fixed input shapes, torch.compile is available since PyTorch 2.0
+        # the forward is compiled in place, thus the state dict of the modules remains unchanged
+        if hasattr(torch, "compile"):
+            for module in (self.encoder_mr, self.decoder):
+                module.forward = torch.compile(module.forward)
+            # the message MLPs of the subdiv module are plain tensor operations, the number of edges varies with the level
+            for gcn_layer in self.GSN.gcn_layers:
+                gcn_layer.lin.forward = torch.compile(gcn_layer.lin.forward, dynamic=True)
+
 
     def _prepare_optimiser(self):
         self.dice_loss_fn = DiceCELoss(
@@ -331,9 +355,15 @@ class TrainPipeline:
 
         # initialise the gradient scaler
         self.scaler = torch.cuda.amp.GradScaler()
+        # the convolutional networks run in bfloat16 where supported, which has the range of float32 and needs no loss scaling,
+        # the subdiv and ndf modules stay in float16 as the pytorch3d kernels in their losses have no bfloat16 support
+        self.amp_dtype = torch.bfloat16 if DEVICE == "cpu" or torch.cuda.is_bf16_supported() else torch.float16
         
         torch.backends.cudnn.enabled = torch.backends.cudnn.is_available()
         torch.backends.cudnn.benchmark = torch.backends.cudnn.is_available()
+        # allow TensorFloat-32 on Ampere or newer GPUs for the float32 convolutions and matmuls outside autocast
+        torch.backends.cudnn.allow_tf32 = True
+        torch.backends.cuda.matmul.allow_tf32 = True
 
 
     def surface_extractor(self, seg_true):
@@ -686,9 +716,10 @@ class TrainPipeline:
                     data_mr["mr_image"].as_tensor().to(DEVICE),
                     data_mr["mr_label"].as_tensor().to(DEVICE),
                     )
+                img_mr = self.intensity_augment(img_mr)
 
                 self.optimzer_mr_unet.zero_grad()
-                with torch.autocast(device_type=DEVICE):
+                with torch.autocast(device_type=DEVICE, dtype=self.amp_dtype):
                     seg_pred_mr = sliding_window_inference(
                         img_mr,
                         roi_size=self.super_params.crop_window_size[:2],
@@ -728,11 +759,12 @@ class TrainPipeline:
                     data_mr["mr_image"].to(DEVICE),
                     data_mr["mr_label"].to(DEVICE),
                 )
+                img_mr = self.intensity_augment(img_mr)
                 batch = data_mr["mr_batch"].item()
                 seg_true_mr = seg_true_mr.unflatten(0, (batch, -1)).swapaxes(1, 2)
 
                 self.optimizer_resnet.zero_grad()
-                with torch.autocast(device_type=DEVICE):
+                with torch.autocast(device_type=DEVICE, dtype=self.amp_dtype):
                     seg_pred_mr = sliding_window_inference(
                         img_mr,
                         roi_size=self.super_params.crop_window_size[:2],
@@ -786,6 +818,7 @@ class TrainPipeline:
                     data_mr["mr_image"].to(DEVICE),
                     data_mr["mr_label"].to(DEVICE),
                 )
+                img_mr = self.intensity_augment(img_mr)
                 batch = data_mr["mr_batch"].item()
                 seg_true_mr = seg_true_mr.unflatten(0, (batch, -1)).swapaxes(1, 2)
                 seg_true_mr_ = torch.stack([self.post_transform({"label": i, "modal": "mr"})["label"] 
@@ -1024,7 +1057,7 @@ class TrainPipeline:
             torch.load(os.path.join(self.ckpt_dir, f"{self.super_params.best_epoch}_GSN.pth")))
         # load the subdivided_faces.faces_levels
         self.subdivided_faces.faces_levels = [torch.load(
-            f"{self.ckpt_dir}/{self.super_params.best_epoch}_subdivided_faces_l{level}.pth"
+            f"{self.ckpt_dir}/{self.super_params.best_epoch}_subdivided_faces_l{level}.pth", map_location=DEVICE
             ) for level in range(self.super_params.subdiv_levels)]
         self.decoder.eval()
         self.GSN.eval()
@@ -1,11 +1,13 @@
 import os, sys
+# keep the freed blocks in the caching allocator and limit the splitting of large blocks to reduce fragmentation,
+# this must be set before torch initialises CUDA (expandable segments need PyTorch >= 2.1, thus not used)
+os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "max_split_size_mb:512")
 sys.path.extend([
     os.path.join(os.path.dirname(__file__), "data"),
     os.path.join(os.path.dirname(__file__), "model"),
     os.path.join(os.path.dirname(__file__), "utils"),
 ])
 import time
-from glob import glob
 import argparse
 import torch
 import wandb
@@ -31,7 +33,7 @@ def train(sweep_params=None):
 
         pipeline = TrainPipeline(
             super_params=sweep_params,
-            seed=8, num_workers=0,
+            seed=8, num_workers=os.cpu_count(),
             )
 
         if sweep_params.save_on == "cap" and sweep_params._4d.lower() == 'y':
@@ -48,7 +50,6 @@ def train(sweep_params=None):
             # train the network
             CKPT = False
             for epoch in range(sweep_params.max_epochs):
-                torch.cuda.empty_cache()
                 if epoch < sweep_params.pretrain_epochs:
                     if sweep_params.use_ckpt is not None and CKPT is False:
                         pipeline.load_pretrained_weight("unet")
@@ -121,6 +122,9 @@ if __name__ == '__main__':
             'cache_rate': {
                 'value': 1.0
             },
+            'cache_dir': {
+                'value': None
+            },
             'crop_window_size': {
                 'value': [128, 128, 128]
             },
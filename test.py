@@ -1,6 +1,5 @@
 import os, sys
 import time
-from glob import glob
 import argparse
 import torch
 import wandb
@@ -40,6 +39,7 @@ def config():
     parser.add_argument("--lr", type=float, default=1e-3, help="the learning rate for training")
     parser.add_argument("--batch_size", type=int, default=1, help="the batch size for training")
     parser.add_argument("--cache_rate", type=float, default=1.0, help="the cache rate for training, see MONAI document for more details")
+    parser.add_argument("--cache_dir", type=str, default=None, help="the path to cache the pre-processed data on disk, data are cached in memory if not specified")
     parser.add_argument("--crop_window_size", type=int, nargs='+', default=[128, 128, 128], help="the size of the crop window for training")
     parser.add_argument("--pixdim", type=float, nargs='+', default=[4, 4, 4], help="the pixel dimension of downsampled images")
     parser.add_argument("--lambda_0", type=float, default=1.06, help="the loss coefficients for Chamfer verts distance term")
@@ -102,7 +102,7 @@ def test(super_params):
     wandb.init(config=super_params, mode="offline", project="MorphiNet-test", name=super_params.run_id.replace("sct", super_params.target))
     pipeline = TrainPipeline(
         super_params=super_params,
-        seed=42, num_workers=19,
+        seed=42, num_workers=os.cpu_count(),
         is_training=False,
         target="acdc" if super_params.target == "acdc" else None
     )
@@ -114,7 +114,7 @@ def ablation(super_params):
     wandb.init(mode="disabled")
     pipeline = TrainPipeline(
         super_params=super_params,
-        seed=42, num_workers=19,
+        seed=42, num_workers=os.cpu_count(),
         is_training=False
     )
     pipeline._data_warper(rotation=False)
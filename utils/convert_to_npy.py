@@ -0,0 +1,44 @@
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+
+import numpy as np
+import tqdm
+from monai.transforms import LoadImage
+
+from data.components import npy_path
+
+
+def convert_to_npy(args):
+    """
+    convert the nifti and nrrd files of a dataset into numpy arrays with their affine matrices, which are loaded as 
+    memory map by `LoadNPYd` during training. the converted files are saved next to the original ones.
+    """
+    loader = LoadImage(ensure_channel_first=False, image_only=True)
+
+    for folder in ["imagesTr", "labelsTr", "imagesTs", "labelsTs"]:
+        folder_path = os.path.join(args.input_dir, folder)
+        if not os.path.isdir(folder_path):
+            continue
+
+        files = [f for f in os.listdir(folder_path) if f.endswith((".nii.gz", ".nii", ".nrrd"))]
+        for file in tqdm.tqdm(files, desc=folder):
+            array_path, affine_path = npy_path(os.path.join(folder_path, file))
+            if os.path.exists(array_path) and not args.overwrite:
+                continue
+            data = loader(os.path.join(folder_path, file))
+            np.save(array_path, data.get_array())
+            np.save(affine_path, data.affine.numpy())
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("-input_dir", "--input_dir", type=str, 
+                        default="/mnt/data/Experiment/Data/MorphiNet-MR_CT/Dataset020_SCOTHEART", 
+                        help="the dataset directory with imagesTr, labelsTr, imagesTs and labelsTs folders")
+    parser.add_argument("-overwrite", "--overwrite", action="store_true", help="whether to overwrite the converted files.")
+
+    args = parser.parse_args()
+
+    convert_to_npy(args)